@@ -4,9 +4,9 @@
 Cython module for the Proesmans optical flow algorithm
 """
 
-#from cython.parallel import parallel, prange
+from cython.parallel import prange
 import numpy as np
-from scipy.ndimage import convolve
+from scipy.ndimage import convolve, median_filter
 
 cimport cython
 cimport numpy as np
@@ -17,27 +17,43 @@ ctypedef np.intp_t intp
 from libc.math cimport floor, sqrt
 
 cdef float64 _INTENSITY_SCALE = 1.0 / 255.0
-
-def _compute_advection_field(float64 [:, :, :] R, lam, intp num_iter,
-                             intp n_levels):
-    R_p = [_construct_image_pyramid(R[0, :, :], n_levels),
-           _construct_image_pyramid(R[1, :, :], n_levels)]
-
-    cdef intp m = R_p[0][-1].shape[0]
-    cdef intp n = R_p[0][-1].shape[1]
+# 3x3 Sobel kernels for computing partial derivatives
+_SOBEL_X = np.array([[1.0, 0.0, -1.0],
+                     [2.0, 0.0, -2.0],
+                     [1.0, 0.0, -1.0]]) / 8.0 * _INTENSITY_SCALE
+_SOBEL_Y = np.array([[1.0, 2.0, 1.0],
+                     [0.0, 0.0, 0.0],
+                     [-1.0, -2.0, -1.0]]) / 8.0 * _INTENSITY_SCALE
+
+def _compute_advection_field(float64 [:, :, ::1] R, lam, intp num_iter,
+                             intp n_levels, intp median_size=0):
+    # the images and motion fields are stored in double precision, each
+    # component in its own contiguous plane
+    R_p = _construct_image_pyramid(R, n_levels)
+
+    cdef intp m = R_p[-1].shape[1]
+    cdef intp n = R_p[-1].shape[2]
 
     cdef np.ndarray[float64, ndim=4] V_cur = np.zeros((2, 2, m, n))
     cdef np.ndarray[float64, ndim=4] V_next
 
+    # coarse-to-fine: each level starts from the upsampled motion field of
+    # the previous one, and the smoother evaluates the temporal derivative on
+    # the second image warped by the current estimate at every iteration
     for i in range(n_levels-1, -1, -1):
-        _proesmans(np.stack([R_p[0][i], R_p[1][i]]), V_cur, num_iter, lam)
-
-        m = R_p[0][i-1].shape[0]
-        n = R_p[0][i-1].shape[1]
+        _proesmans(R_p[i], V_cur, num_iter, lam)
 
-        V_next = np.zeros((2, 2, m, n))
+        if median_size > 1:
+            # remove outliers from the forward and backward motion fields
+            for j in range(2):
+                for k in range(2):
+                    V_cur[j, k] = median_filter(V_cur[j, k], size=median_size)
 
         if i > 0:
+            m = R_p[i-1].shape[1]
+            n = R_p[i-1].shape[2]
+
+            V_next = np.zeros((2, 2, m, n))
             _initialize_next_level(V_cur, V_next)
             V_cur = V_next
 
@@ -47,26 +63,30 @@ def _compute_advection_field(float64 [:, :, :] R, lam, intp num_iter,
 @cython.wraparound(False)
 @cython.nonecheck(False)
 @cython.cdivision(True)
-cdef _compute_next_pyramid_level(float64 [:, :] I_src,
-                                 float64 [:, :] I_dest):
-    cdef intp dh = I_dest.shape[0]
-    cdef intp dw = I_dest.shape[1]
-    cdef intp x, y
-
-    for y in range(dh):
-        for x in range(dw):
-            I_dest[y, x] = (I_src[2*y, 2*x] + I_src[2*y, 2*x+1] + \
-                            I_src[2*y+1, 2*x] + I_src[2*y+1, 2*x+1]) / 4.0
-
-cdef _construct_image_pyramid(float64 [:, :] R, intp n_levels):
-    cdef intp m = R.shape[0]
-    cdef intp n = R.shape[1]
-    cdef np.ndarray[float64, ndim=2] R_next
+cdef _compute_next_pyramid_level(float64 [:, :, ::1] I_src,
+                                 float64 [:, :, ::1] I_dest):
+    # 2x2 block average, only the pixels of the coarser level are computed
+    cdef intp dh = I_dest.shape[1]
+    cdef intp dw = I_dest.shape[2]
+    cdef intp k, x, y
+
+    for k in range(I_dest.shape[0]):
+        for y in prange(dh, schedule='static', nogil=True):
+            for x in range(dw):
+                I_dest[k, y, x] = (I_src[k, 2*y, 2*x] + I_src[k, 2*y, 2*x+1] + \
+                                   I_src[k, 2*y+1, 2*x] + \
+                                   I_src[k, 2*y+1, 2*x+1]) / 4.0
+
+cdef _construct_image_pyramid(float64 [:, :, ::1] R, intp n_levels):
+    # both images are decimated together, each level is a (2, m, n) array
+    cdef intp m = R.shape[1]
+    cdef intp n = R.shape[2]
+    cdef np.ndarray[float64, ndim=3] R_next
 
     R_out = [R]
-    cdef float64 [:, :] R_cur = R
+    cdef float64 [:, :, ::1] R_cur = R
     for i in range(1, n_levels):
-        R_next = np.zeros((int(m/2), int(n/2)))
+        R_next = np.empty((R.shape[0], int(m/2), int(n/2)))
         _compute_next_pyramid_level(R_cur, R_next)
         R_cur = R_next
 
@@ -80,10 +100,11 @@ cdef _construct_image_pyramid(float64 [:, :] R, intp n_levels):
 @cython.wraparound(False)
 @cython.nonecheck(False)
 @cython.cdivision(True)
-cdef _proesmans(float64 [:, :, :] R, float64 [:, :, :, :] V, intp num_iter,
+cdef _proesmans(float64 [:, :, ::1] R, float64 [:, :, :, ::1] V, intp num_iter,
                 float64 lam):
     cdef intp x, y
     cdef intp i, j
+    cdef intp color
     cdef float64 xd, yd
     cdef float64 It
     cdef float64 ic
@@ -92,57 +113,71 @@ cdef _proesmans(float64 [:, :, :] R, float64 [:, :, :, :] V, intp num_iter,
     cdef intp m = R.shape[1]
     cdef intp n = R.shape[2]
 
-    cdef np.ndarray[float64, ndim=4] G = np.zeros((2, 2, R.shape[1], R.shape[2]))
+    cdef np.ndarray[float64, ndim=4] G = np.empty((2, 2, R.shape[1], R.shape[2]))
 
-    G[0, :, :, :] = _compute_gradients(R[0, :, :])
-    G[1, :, :, :] = _compute_gradients(R[1, :, :])
+    _compute_gradients(R[0, :, :], G[0])
+    _compute_gradients(R[1, :, :], G[1])
+
+    # the gradient-dependent factor lam / (1 + lam * |grad(I)|^2) of the
+    # update does not change between the iterations
+    cdef np.ndarray[float64, ndim=3] W = \
+        lam / (1.0 + lam * (G[:, 0, :, :] ** 2 + G[:, 1, :, :] ** 2))
 
     cdef np.ndarray[float64, ndim=3] GAMMA = np.zeros((2, R.shape[1], R.shape[2]))
+    # row buffers of the consistency maps, allocated once per level
+    cdef float64 [::1] c_sum_row = np.empty(m)
+    cdef intp [::1] c_count_row = np.empty(m, dtype=np.intp)
     cdef float64 v_avg_1, v_avg_2
     cdef float64 v_next_1, v_next_2
 
-    cdef float64 [:, :] R_j_1
-    cdef float64 [:, :] R_j_2
-    cdef float64 [:, :] G_j_1
-    cdef float64 [:, :] G_j_2
-    cdef float64 [:, :, :] V_j
-    cdef float64 [:, :] GAMMA_j
+    cdef float64 [:, ::1] R_j_1
+    cdef float64 [:, ::1] R_j_2
+    cdef float64 [:, ::1] G_j_1
+    cdef float64 [:, ::1] G_j_2
+    cdef float64 [:, ::1] W_j
+    cdef float64 [:, :, ::1] V_j
+    cdef float64 [:, ::1] GAMMA_j
 
     for i in range(num_iter):
-        _compute_consistency_maps(V, GAMMA)
+        _compute_consistency_maps(V, GAMMA, c_sum_row, c_count_row)
 
         for j in range(2):
             R_j_1 = R[j, :, :]
             R_j_2 = R[1-j, :, :]
             G_j_1 = G[j, 0, :, :]
             G_j_2 = G[j, 1, :, :]
+            W_j = W[j, :, :]
             V_j = V[j, :, :, :]
             GAMMA_j = GAMMA[j, :, :]
 
-            for y in range(1, m-1):
-            #for y in prange(1, m - 1, schedule='static', nogil=True):
-                for x in range(1, n-1):
-                    v_avg_1 = _compute_laplacian(GAMMA_j, V_j, x, y, 0)
-                    v_avg_2 = _compute_laplacian(GAMMA_j, V_j, x, y, 1)
-
-                    xd = x + v_avg_1
-                    yd = y + v_avg_2
-                    if xd >= 0 and xd < n - 1 and yd >= 0 and yd < m - 1:
-                        It = (_linear_interpolate(R_j_2, xd, yd) - \
-                            R_j_1[y, x]) * _INTENSITY_SCALE
-                        gx = G_j_1[y, x]
-                        gy = G_j_2[y, x]
-                        ic = lam * It / (1.0 + lam * (gx * gx + gy * gy))
-                        v_next_1 = v_avg_1 - gx * ic
-                        v_next_2 = v_avg_2 - gy * ic
-                    else:
-                        # use consistency-weighted average as the next value
-                        # if (xd,yd) is outside the image
-                        v_next_1 = v_avg_1
-                        v_next_2 = v_avg_2
-
-                    V_j[0, y, x] = v_next_1
-                    V_j[1, y, x] = v_next_2
+            # zebra (red-black by rows) Gauss-Seidel: the stencil of a row
+            # only reads the rows above and below it, so the odd and the even
+            # rows can each be updated in parallel, the odd rows first
+            for color in range(2):
+                for y in prange(1 + color, m - 1, 2, schedule='static',
+                                nogil=True):
+                    for x in range(1, n-1):
+                        v_avg_1 = _compute_laplacian(GAMMA_j, V_j, x, y, 0)
+                        v_avg_2 = _compute_laplacian(GAMMA_j, V_j, x, y, 1)
+
+                        xd = x + v_avg_1
+                        yd = y + v_avg_2
+                        if xd >= 0 and xd < n - 1 and yd >= 0 and yd < m - 1:
+                            It = (_linear_interpolate(R_j_2, xd, yd) - \
+                                R_j_1[y, x]) * _INTENSITY_SCALE
+                            gx = G_j_1[y, x]
+                            gy = G_j_2[y, x]
+                            ic = It * W_j[y, x]
+                            v_next_1 = v_avg_1 - gx * ic
+                            v_next_2 = v_avg_2 - gy * ic
+                        else:
+                            # use consistency-weighted average as the next
+                            # value if (xd,yd) is outside the image
+                            v_next_1 = v_avg_1
+                            v_next_2 = v_avg_2
+
+                        V_j[0, y, x] = v_next_1
+                        V_j[1, y, x] = v_next_2
 
             _fill_edges(V[j, :, :, :])
 
@@ -150,8 +185,9 @@ cdef _proesmans(float64 [:, :, :] R, float64 [:, :, :, :] V, intp num_iter,
 @cython.wraparound(False)
 @cython.nonecheck(False)
 @cython.cdivision(True)
-cdef float64 _compute_laplacian(float64 [:, :] gi, float64 [:, :, :] Vi, intp x,
-                                intp y, intp j): #nogil:
+cdef inline float64 _compute_laplacian(float64 [:, ::1] gi,
+                                       float64 [:, :, ::1] Vi,
+                                       intp x, intp y, intp j) noexcept nogil:
     cdef float64 v
     cdef float64 sumWeights = (gi[y-1, x] + gi[y, x-1] + \
                               gi[y, x+1] + gi[y+1, x]) / 6.0 + \
@@ -172,8 +208,13 @@ cdef float64 _compute_laplacian(float64 [:, :] gi, float64 [:, :, :] Vi, intp x,
 @cython.wraparound(False)
 @cython.nonecheck(False)
 @cython.cdivision(True)
-cdef void _compute_consistency_maps(float64 [:, :, :, :] V,
-                                    float64 [:, :, :] GAMMA):
+cdef void _compute_consistency_maps(float64 [:, :, :, ::1] V,
+                                    float64 [:, :, ::1] GAMMA,
+                                    float64 [::1] c_sum_row,
+                                    intp [::1] c_count_row):
+    # c_sum_row and c_count_row are work buffers of length m for the per-row
+    # partial sums, which are accumulated serially afterwards so that the
+    # result does not depend on the number of threads
     cdef intp x, y
     cdef intp i
     cdef intp m, n
@@ -183,25 +224,26 @@ cdef void _compute_consistency_maps(float64 [:, :, :, :] V,
     cdef float64 c
     cdef float64 c_sum
     cdef intp c_count
+    cdef float64 c_row_sum
+    cdef intp c_row_count
     cdef float64 K
     cdef float64 g
 
-    cdef float64 [:, :] V11, V12, V21, V22
+    cdef float64 [:, ::1] V11, V12, V21, V22
 
     m = V.shape[2]
     n = V.shape[3]
 
     for i in range(2):
-        c_sum = 0.0
-        c_count = 0
 
         V11 = V[i, 0, :, :]
         V12 = V[i, 1, :, :]
         V21 = V[1-i, 0, :, :]
         V22 = V[1-i, 1, :, :]
 
-        #for y in prange(m, schedule='guided', nogil=True):
-        for y in range(m):
+        for y in prange(m, schedule='static', nogil=True):
+            c_row_sum = 0.0
+            c_row_count = 0
             for x in range(n):
                 xd = x + V[i, 0, y, x]
                 yd = y + V[i, 1, y, x]
@@ -216,18 +258,26 @@ cdef void _compute_consistency_maps(float64 [:, :, :, :] V,
                     c = sqrt(uDiff * uDiff + vDiff * vDiff)
 
                     GAMMA[i, y, x] = c
-                    c_sum += c
-                    c_count += 1
+                    c_row_sum = c_row_sum + c
+                    c_row_count = c_row_count + 1
                 else:
                     GAMMA[i, y, x] = -1.0
 
+            c_sum_row[y] = c_row_sum
+            c_count_row[y] = c_row_count
+
+        c_sum = 0.0
+        c_count = 0
+        for y in range(m):
+            c_sum += c_sum_row[y]
+            c_count += c_count_row[y]
+
         if c_count > 0:
             K = 0.9 * c_sum / c_count
         else:
             K = 0.0
 
-        #for y in prange(m, schedule='guided', nogil=True):
-        for y in range(m):
+        for y in prange(m, schedule='static', nogil=True):
             for x in range(n):
                 if K > 1e-8:
                     if GAMMA[i, y, x] >= 0.0:
@@ -238,43 +288,16 @@ cdef void _compute_consistency_maps(float64 [:, :, :, :] V,
                 else:
                     GAMMA[i, y, x] = 1.0
 
-cdef np.ndarray[float64, ndim=3] _compute_gradients(float64 [:, :]  I):
-    # use 3x3 Sobel kernels for computing partial derivatives
-    cdef np.ndarray[float64, ndim=2] Kx = np.zeros((3, 3))
-    cdef np.ndarray[float64, ndim=2] Ky = np.zeros((3, 3))
-
-    Kx[0, 0] = 1.0 / 8.0 * _INTENSITY_SCALE
-    Kx[0, 1] = 0.0
-    Kx[0, 2] = -1.0 / 8.0 * _INTENSITY_SCALE
-    Kx[1, 0] = 2.0 / 8.0 * _INTENSITY_SCALE
-    Kx[1, 1] = 0.0
-    Kx[1, 2] = -2.0 / 8.0 * _INTENSITY_SCALE
-    Kx[2, 0] = 1.0 / 8.0 * _INTENSITY_SCALE
-    Kx[2, 1] = 0.0
-    Kx[2, 2] = -1.0 / 8.0 * _INTENSITY_SCALE
-
-    Ky[0, 0] = 1.0 / 8.0 * _INTENSITY_SCALE
-    Ky[0, 1] = 2.0 / 8.0 * _INTENSITY_SCALE
-    Ky[0, 2] = 1.0 / 8.0 * _INTENSITY_SCALE
-    Ky[1, 0] = 0.0
-    Ky[1, 1] = 0.0
-    Ky[1, 2] = 0.0
-    Ky[2, 0] = -1.0 / 8.0 * _INTENSITY_SCALE
-    Ky[2, 1] = -2.0 / 8.0 * _INTENSITY_SCALE
-    Ky[2, 2] = -1.0 / 8.0 * _INTENSITY_SCALE
-
-    cdef np.ndarray[float64, ndim=3] G = np.zeros((2, I.shape[0], I.shape[1]))
-
-    G[0, :, :] = convolve(I, Kx, mode="constant", cval=0.0)
-    G[1, :, :] = convolve(I, Ky, mode="constant", cval=0.0)
-
-    return G
+cdef _compute_gradients(float64 [:, ::1] I, G):
+    # compute the partial derivatives of I into G[0] and G[1]
+    convolve(I, _SOBEL_X, output=G[0], mode="constant", cval=0.0)
+    convolve(I, _SOBEL_Y, output=G[1], mode="constant", cval=0.0)
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.nonecheck(False)
 @cython.cdivision(True)
-cdef void _fill_edges(float64 [:, :, :] V): #nogil:
+cdef void _fill_edges(float64 [:, :, ::1] V): #nogil:
     cdef intp x, y
     cdef intp i
 
@@ -302,8 +325,8 @@ cdef void _fill_edges(float64 [:, :, :] V): #nogil:
 @cython.wraparound(False)
 @cython.nonecheck(False)
 @cython.cdivision(True)
-cdef _initialize_next_level(float64 [:, :, :, :] V_prev,
-                            float64 [:, :, :, :] V_next):
+cdef _initialize_next_level(float64 [:, :, :, ::1] V_prev,
+                            float64 [:, :, :, ::1] V_next):
     cdef intp m_prev = V_prev.shape[2]
     cdef intp n_prev = V_prev.shape[3]
 
@@ -316,12 +339,12 @@ cdef _initialize_next_level(float64 [:, :, :, :] V_prev,
     cdef intp xci, yci
     cdef intp xn, yn
 
-    cdef float64 [:, :] V_prev_1 = V_prev[0, 0, :, :]
-    cdef float64 [:, :] V_prev_2 = V_prev[0, 1, :, :]
-    cdef float64 [:, :] V_prev_3 = V_prev[1, 0, :, :]
-    cdef float64 [:, :] V_prev_4 = V_prev[1, 1, :, :]
+    cdef float64 [:, ::1] V_prev_1 = V_prev[0, 0, :, :]
+    cdef float64 [:, ::1] V_prev_2 = V_prev[0, 1, :, :]
+    cdef float64 [:, ::1] V_prev_3 = V_prev[1, 0, :, :]
+    cdef float64 [:, ::1] V_prev_4 = V_prev[1, 1, :, :]
 
-    for yn in range(m_next):
+    for yn in prange(m_next, schedule='static', nogil=True):
         yc = yn / 2.0
         yci = yn / 2
         for xn in range(n_next):
@@ -352,10 +375,11 @@ cdef _initialize_next_level(float64 [:, :, :, :] V_prev,
 @cython.wraparound(False)
 @cython.nonecheck(False)
 @cython.cdivision(True)
-cdef float64 _linear_interpolate(float64 [:, :] I, float64 x, float64 y): #nogil:
-    cdef intp x0 = int(x)
+cdef inline float64 _linear_interpolate(float64 [:, ::1] I, float64 x,
+                                        float64 y) noexcept nogil:
+    cdef intp x0 = <intp>x
     cdef intp x1 = x0 + 1
-    cdef intp y0 = int(y)
+    cdef intp y0 = <intp>y
     cdef intp y1 = y0 + 1
 
     if x0 < 0:
@@ -19,7 +19,8 @@ from pysteps.motion._proesmans import _compute_advection_field
 
 @check_input_frames(2, 2)
 def proesmans(input_images, lam=50.0, num_iter=100,
-              num_levels=6, filter_std=0.0, verbose=True, ):
+              num_levels=6, filter_std=0.0, median_filter_size=0,
+              verbose=True, ):
     """Implementation of the anisotropic diffusion method of Proesmans et al.
     (1994).
 
@@ -37,6 +38,10 @@ def proesmans(input_images, lam=50.0, num_iter=100,
     filter_std : float
         Standard deviation of an optional Gaussian filter that is applied before
         computing the optical flow.
+    median_filter_size : int
+        Size of an optional median filter that is applied to the motion field
+        after the iterations at each pyramid level (a typical size is 5).
+        The filter is not applied if the size is less than 2 (default).
     verbose : bool, optional
         Verbosity enabled if True (default).
 
@@ -55,17 +60,20 @@ def proesmans(input_images, lam=50.0, num_iter=100,
     """
     del verbose  # Not used
 
-    im1 = input_images[-2, :, :].copy()
-    im2 = input_images[-1, :, :].copy()
-
-    im = np.stack([im1, im2])
+    # single contiguous copy of the last two frames, normalized in place. The
+    # copy is made in the double precision used by the solver, so that no
+    # further conversion is needed.
+    im = np.array(input_images[-2:, :, :], dtype=np.float64, order="C")
     im_min = np.min(im)
     im_max = np.max(im)
     if im_max - im_min > 1e-8:
-        im = (im - im_min) / (im_max - im_min) * 255.0
+        scale = 255.0 / (im_max - im_min)
+        np.multiply(im, scale, out=im)
+        np.add(im, -im_min * scale, out=im)
 
     if filter_std > 0.0:
-        im[0, :, :] = gaussian_filter(im[0, :, :], filter_std)
-        im[1, :, :] = gaussian_filter(im[1, :, :], filter_std)
+        # filter both images in a single call, only along the spatial axes
+        gaussian_filter(im, (0.0, filter_std, filter_std), output=im)
 
-    return _compute_advection_field(im, lam, num_iter, num_levels)
+    return _compute_advection_field(im, lam, num_iter, num_levels,
+                                    median_filter_size)
@@ -4,9 +4,11 @@ Testing helper functions
 
 Collection of helper functions for the testing suite.
 """
+import copy
 import numpy as np
 import pytest
 from datetime import datetime
+from functools import lru_cache
 
 import pysteps as stp
 from pysteps import io, rcparams, utils
@@ -104,13 +106,32 @@ def get_precipitation_fields(num_prev_files=0,
     if source == "saf":
         pytest.importorskip("netCDF4")
 
-    try:
-        date = _reference_dates[source]
-    except KeyError:
+    if source not in _reference_dates:
         raise ValueError(f"Unknown source name '{source}'\n"
                          "The available data sources are: "
                          f"{str(list(_reference_dates.keys()))}")
 
+    reference_field, ref_metadata = _get_precipitation_fields_cached(
+        num_prev_files, num_next_files, return_raw, upscale, source)
+
+    # Return copies so that the tests cannot modify the cached fields
+    reference_field = reference_field.copy()
+
+    if metadata:
+        return reference_field, copy.deepcopy(ref_metadata)
+
+    return reference_field
+
+
+@lru_cache(maxsize=64)
+def _get_precipitation_fields_cached(num_prev_files, num_next_files,
+                                     return_raw, upscale, source):
+    """
+    Read and pre-process the precipitation fields. The results are cached
+    so that each archive configuration is read only once per test session.
+    """
+    date = _reference_dates[source]
+
     data_source = rcparams.data_sources[source]
     root_path = data_source["root_path"]
     path_fmt = data_source["path_fmt"]
@@ -150,8 +171,10 @@ def get_precipitation_fields(num_prev_files=0,
                                                                ref_metadata,
                                                                upscale)
 
-        # Mask invalid values
-        reference_field = np.ma.masked_invalid(reference_field)
+        # Find the invalid values and set them to the fill value. The field
+        # is processed as a plain array and only masked at the end.
+        mask = ~np.isfinite(reference_field)
+        np.copyto(reference_field, -15.0, where=mask)
 
         # Log-transform the data [dBR]
         reference_field, ref_metadata = stp.utils.dB_transform(reference_field,
@@ -159,14 +182,11 @@ def get_precipitation_fields(num_prev_files=0,
                                                                threshold=0.1,
                                                                zerovalue=-15.0)
 
-        # Set missing values with the fill value
-        np.ma.set_fill_value(reference_field, -15.0)
-        reference_field.data[reference_field.mask] = -15.0
-
-    if metadata:
-        return reference_field, ref_metadata
+        # Mask invalid values
+        reference_field = np.ma.MaskedArray(reference_field, mask=mask,
+                                            fill_value=-15.0)
 
-    return reference_field
+    return reference_field, ref_metadata
 
 
 def smart_assert(actual_value, expected, tolerance=None):
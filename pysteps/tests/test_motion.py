@@ -144,25 +144,34 @@ def _create_observations(input_precip, motion_type, num_times=9):
 
 
 convergence_arg_names = ("input_precip, optflow_method_name, motion_type, "
-                         "num_times, max_rel_rmse")
-
-convergence_arg_values = [(reference_field, 'lk', 'linear_x', 2, 0.1),
-                          (reference_field, 'lk', 'linear_y', 2, 0.1),
-                          (reference_field, 'lk', 'linear_x', 3, 0.1),
-                          (reference_field, 'lk', 'linear_y', 3, 0.1),
-                          (reference_field, 'vet', 'linear_x', 2, 0.1),
-                          # (reference_field, 'vet', 'linear_x', 3, 9),
-                          # (reference_field, 'vet', 'linear_y', 2, 9),
-                          (reference_field, 'vet', 'linear_y', 3, 0.1),
-                          (reference_field, 'proesmans', 'linear_x', 2, 0.45),
-                          (reference_field, 'proesmans', 'linear_y', 2, 0.45),
-                          (reference_field, 'darts', 'linear_x', 9, 20),
-                          (reference_field, 'darts', 'linear_y', 9, 20)]
+                         "num_times, max_rel_rmse, optflow_kwargs")
+
+convergence_arg_values = [(reference_field, 'lk', 'linear_x', 2, 0.1, {}),
+                          (reference_field, 'lk', 'linear_y', 2, 0.1, {}),
+                          (reference_field, 'lk', 'linear_x', 3, 0.1, {}),
+                          (reference_field, 'lk', 'linear_y', 3, 0.1, {}),
+                          (reference_field, 'vet', 'linear_x', 2, 0.1, {}),
+                          # (reference_field, 'vet', 'linear_x', 3, 9, {}),
+                          # (reference_field, 'vet', 'linear_y', 2, 9, {}),
+                          (reference_field, 'vet', 'linear_y', 3, 0.1, {}),
+                          (reference_field, 'proesmans', 'linear_x', 2, 0.45,
+                           {}),
+                          (reference_field, 'proesmans', 'linear_y', 2, 0.45,
+                           {}),
+                          # the median filter can increase the error of the
+                          # retrieved field up to ~3 times on synthetic fields
+                          (reference_field, 'proesmans', 'linear_x', 2, 1.5,
+                           dict(median_filter_size=5)),
+                          (reference_field, 'proesmans', 'linear_y', 2, 1.5,
+                           dict(median_filter_size=5)),
+                          (reference_field, 'darts', 'linear_x', 9, 20, {}),
+                          (reference_field, 'darts', 'linear_y', 9, 20, {})]
 
 
 @pytest.mark.parametrize(convergence_arg_names, convergence_arg_values)
 def test_optflow_method_convergence(input_precip, optflow_method_name,
-                                    motion_type, num_times, max_rel_rmse):
+                                    motion_type, num_times, max_rel_rmse,
+                                    optflow_kwargs):
     """
     Test the convergence to the actual solution of the optical flow method used.
 
@@ -193,6 +202,15 @@ def test_optflow_method_convergence(input_precip, optflow_method_name,
 
             - linear_x: (u=2, v=0)
             - linear_y: (u=0, v=2)
+
+    num_times: int
+        Length of the observations sequence.
+
+    max_rel_rmse: float
+        Maximum relative RMSE (in %) of the retrieved motion field.
+
+    optflow_kwargs: dict
+        Additional keyword arguments passed to the optical flow method.
     """
     if optflow_method_name == 'lk':
         pytest.importorskip('cv2')
@@ -209,12 +227,16 @@ def test_optflow_method_convergence(input_precip, optflow_method_name,
         # To increase the stability of the tests to we increase this value to
         # maxiter=150.
         retrieved_motion = oflow_method(precip_obs, verbose=False,
-                                       options=dict(maxiter=150, method='BFGS'))
+                                       options=dict(maxiter=150, method='BFGS'),
+                                       **optflow_kwargs)
     elif optflow_method_name == 'proesmans':
-        retrieved_motion = oflow_method(precip_obs)
+        retrieved_motion = oflow_method(precip_obs, **optflow_kwargs)
     else:
 
-        retrieved_motion = oflow_method(precip_obs, verbose=False)
+        retrieved_motion = oflow_method(precip_obs, verbose=False,
+                                        **optflow_kwargs)
+
+    assert retrieved_motion.shape == ideal_motion.shape
 
     precip_data, _ = stp.utils.dB_transform(precip_obs.max(axis=0),
                                             inverse=True)